@@ -4,7 +4,6 @@ import yaml
 import re
 import sys
 import itertools
-import tempfile
 import os
 import logging
 
@@ -13,26 +12,25 @@ logger = logging.getLogger(__name__)
 ARG_NAME = re.compile(r"[^.\[]+")
 
 class TempfileArg:
-    def __init__(self, suffix=None, prefix=None, dir=None):
+    """Stands in for `TempFile` during template expansion.
+
+       Attributes expand to placeholders, the files themselves are only
+       created when the rule is run (see CmdScript.make_temps).
+    """
+    def __init__(self):
         self.tmpfiles = {}
-        self.dir_ = dir
-        self.suffix = suffix
-        self.prefix = prefix
 
     def reset(self):
         self.tmpfiles = {}
 
     def __getattr__(self, attr):
-        if attr in self.tmpfiles:
-            return self.tmpfiles[attr]
+        if attr.startswith('__'):
+            raise AttributeError(attr)
 
-        try:
-            return super().__getattr__(attr)
-        except AttributeError:
-            h, f = tempfile.mkstemp(prefix=self.prefix or attr, suffix=self.suffix, dir=self.dir_)
-            os.close(h)
-            self.tmpfiles[attr] = f
-            return self.tmpfiles[attr]
+        if attr not in self.tmpfiles:
+            self.tmpfiles[attr] = f"@@TempFile.{attr}@@"
+
+        return self.tmpfiles[attr]
 
 class ScriptTemplate:
     def __init__(self, name, template):
@@ -43,6 +41,7 @@ class ScriptTemplate:
         self.template = template['cmds'].strip()
 
         self.serial = template.get('serial', False)
+        self.depends = [self._parse_depends(d) for d in template.get('depends', [])]
         self._ss = None
         self.inherited_semaphores = {}
         self.parse()
@@ -50,6 +49,19 @@ class ScriptTemplate:
     def set_script(self, script):
         self.script = script
 
+    def _parse_depends(self, dep):
+        if isinstance(dep, str):
+            dep = {'rule': dep}
+
+        assert isinstance(dep, dict) and 'rule' in dep, f'{self.name}: dependency {dep} missing "rule"'
+
+        unknown = set(dep.keys()) - {'rule', 'script', 'vars'}
+        assert not unknown, f'{self.name}: unrecognized keys {unknown} in dependency on {dep["rule"]}'
+
+        return {'rule': dep['rule'],
+                'script': dep.get('script', None),
+                'vars': dict(dep.get('vars', {}))}
+
     @property
     def serial_semaphore(self):
         if self._ss is None:
@@ -115,6 +127,10 @@ class ScriptTemplate:
                             self.inherited_semaphores[templates[tmpl].serial_semaphore.name] = templates[tmpl].serial_semaphore
 
                         self.inherited_semaphores.update(templates[tmpl].inherited_semaphores)
+
+                        for d in templates[tmpl].depends:
+                            if d not in self.depends:
+                                self.depends.append(d)
                     else:
                         out.append(x)
                 else:
@@ -270,9 +286,20 @@ class Script:
         return self._templates
 
 
+def instance_key(script, template, assign):
+    """Return a hashable key identifying an instance of a rule.
+
+       Two instances with the same key run the same template with the
+       same variable assignment and are therefore interchangeable.
+    """
+    return (script.ns, template,
+            tuple(sorted([(k, repr(v)) for k, v in assign.items()
+                          if not (k.startswith('_') or k == 'TempFile')])))
+
 class BMK3:
     def __init__(self):
-        pass
+        self.scripts = []
+        self._paths = {}
 
     def load_scripts(self, scriptfiles, strip_prefix = ''):
         out = []
@@ -286,6 +313,7 @@ class BMK3:
             out.append(s)
 
         self.scripts = out
+        self._paths = dict([(os.path.realpath(s.script), s) for s in out])
         return out
 
     def update_variables(self, variables):
@@ -304,6 +332,47 @@ class BMK3:
             for t, g in s.generate(s.variables, template_filter):
                 yield s, t, g
 
+    def dependencies(self, script, template, assign):
+        """Generate the instances that an instance of a rule depends on.
+
+           Variables used by a dependency take their values from the
+           assignment of the dependent rule, either by name or through
+           the `vars` mapping. Any remaining variables range over their
+           values in the dependency's script.
+        """
+        for d in script.templates[template].depends:
+            if d['script'] is not None:
+                path = os.path.realpath(os.path.join(script.cwd, d['script']))
+                if path not in self._paths:
+                    raise KeyError(f"Script {d['script']} required by rule {template} is not loaded")
+
+                ds = self._paths[path]
+            else:
+                ds = script
+
+            if d['rule'] not in ds.templates:
+                raise KeyError(f"Rule {d['rule']} required by rule {template} not found in {ds.script}")
+
+            dt = ds.templates[d['rule']]
+
+            unknown = set(d['vars'].keys()) - dt.variables
+            if unknown:
+                raise KeyError(f"Variables {unknown} mapped by rule {template} are not used by rule {d['rule']}")
+
+            varvals = dict(ds.variables)
+            for v in dt.variables:
+                if v == 'TempFile': continue
+
+                src = d['vars'].get(v, v)
+                if src in assign:
+                    # wrap, so that list values are treated as singletons
+                    varvals[v] = [assign[src]]
+                elif v in d['vars']:
+                    raise KeyError(f"Variable {src} mapped to {v} of rule {d['rule']} not specified for rule {template}")
+
+            for g in dt.generate(varvals, filters=ds.filters):
+                yield ds, d['rule'], g
+
 class Sem:
     """A semaphore specification"""
     def __init__(self, name, count):
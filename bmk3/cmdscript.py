@@ -1,23 +1,32 @@
 #!/usr/bin/env python3
 
-from .runner import run
+from .runner import run, RunResult
 import logging
 import tempfile
+import shutil
 import os
 
 logger = logging.getLogger(__name__)
 
 class CmdScript:
-    def __init__(self, name, script, varvals, cwd = None):
+    def __init__(self, name, script, varvals, cwd = None, key = None, depends = None):
         self.name = name
         self.script = script
         self.varvals = varvals
         self.cwd = cwd
+        self.key = key if key is not None else name
+        self.depends = list(depends) if depends else [] # keys of CmdScripts that must succeed first
+        self.skipped = False
+        self.tmpdir = None
         self.timing = None # this is set by a runner: to have better logging?
 
     def get_stats(self):
         out = []
 
+        if self.skipped:
+            out.append({'success': False, 'skipped': True})
+            return out
+
         for r, t in zip([self.result], [self.timing]): # in prep for multiple runs
             out.append({'success': r.success,
                         'start': t.start,
@@ -38,12 +47,31 @@ class CmdScript:
 
         return self.result.success
 
+    def skip(self):
+        self.skipped = True
+        self.result = RunResult(success=False, returncode=None, output=None, errors=None,
+                                exception=None, processobj=None, outfile=None, errfile=None)
+
+    def make_temps(self, scratch = None):
+        """Create the temporary files used by this script in a fresh
+           directory under scratch and substitute their names."""
+
+        if not self.varvals.get('TempFile'):
+            return
+
+        # rules run in their script's directory, so names must be absolute
+        self.tmpdir = os.path.abspath(tempfile.mkdtemp(prefix='bmk3-', dir=scratch))
+        logger.debug(f'Creating temporary files for {self.name} in {self.tmpdir}')
+
+        for k, v in self.varvals['TempFile'].items():
+            f = os.path.join(self.tmpdir, k)
+            open(f, 'w').close()
+            self.script = self.script.replace(v, f)
+
     def cleanup(self):
-        if 'TempFile' in self.varvals:
-            for k, v in self.varvals['TempFile'].items():
-                if os.path.exists(v):
-                    logger.debug(f'Deleting temporary file {v}')
-                    os.unlink(v)
+        if self.tmpdir is not None and os.path.exists(self.tmpdir):
+            logger.debug(f'Deleting temporary files in {self.tmpdir}')
+            shutil.rmtree(self.tmpdir)
 
     def __str__(self):
         return f"CmdScript(name={repr(self.name)}, script={repr(self.script)})"
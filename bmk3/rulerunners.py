@@ -8,6 +8,8 @@ from collections import namedtuple
 import random
 import itertools
 import multiprocessing
+import queue
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -15,8 +17,12 @@ TimeRecord = namedtuple('TimeRecord', 'start end total')
 
 PREFIX_OUTPUT = True
 
-def _run_one(c, dry_run = False, keep_temps = 'fail', quiet = False):
+def _run_one(c, dry_run = False, keep_temps = 'fail', quiet = False, scratch = None):
     fail = False
+
+    if not dry_run:
+        c.make_temps(scratch)
+
     logger.info(f"**** {c.name} from {c.cwd}")
 
     logger.info(textwrap.indent("\n" + str(c.script), '    '))
@@ -58,98 +64,137 @@ def _run_one(c, dry_run = False, keep_temps = 'fail', quiet = False):
         if keep_temps == 'never' or (keep_temps == 'fail' and not fail):
             c.cleanup()
 
+    if c.tmpdir is not None and os.path.exists(c.tmpdir):
+        logger.info(f'Keeping temporary files for {c.name} in {c.tmpdir}')
+
     return c
 
+def _skip_one(c, failed):
+    logger.error(f'Skipping {c.name}, prerequisites {", ".join(failed)} did not succeed')
+    c.skip()
+
+    return c
+
+def toposort(cmdscripts):
+    """Order cmdscripts so that every cmdscript follows its dependencies.
+
+       Cmdscripts retain their relative order where possible. Raises
+       ValueError if the dependencies contain a cycle."""
+
+    keys = set([c.key for c in cmdscripts])
+    placed = set()
+    out = []
+    pending = list(cmdscripts)
+
+    while pending:
+        waiting = []
+        for c in pending:
+            if all([d in placed or d not in keys for d in c.depends]):
+                out.append(c)
+                placed.add(c.key)
+            else:
+                waiting.append(c)
+
+        if len(waiting) == len(pending):
+            names = []
+            for c in waiting:
+                if c.name not in names:
+                    names.append(c.name)
+
+            raise ValueError(f"Dependency cycle among rules {', '.join(names)}")
+
+        pending = waiting
+
+    return out
+
+def _failed_deps(c, status, names):
+    out = []
+    for d in c.depends:
+        if d in status and not status[d] and names[d] not in out:
+            out.append(names[d])
+
+    return out
+
+# Runners expect cmdscripts to be ordered by toposort
+
 class SerialRunner:
-    def run_all(self, cmdscripts, dry_run = False, keep_temps = 'fail', quiet = False):
+    def run_all(self, cmdscripts, dry_run = False, keep_temps = 'fail', quiet = False, scratch = None):
         assert keep_temps in ('fail', 'never', 'always'), f"Incorrect value for keep_temps: {keep_temps}, must be one of fail, never or always"
 
+        names = dict([(c.key, c.name) for c in cmdscripts])
+        status = {}
+
         out = []
         for c in cmdscripts:
-            cr = _run_one(c, dry_run, keep_temps, quiet)
+            failed = _failed_deps(c, status, names)
+            if failed:
+                cr = _skip_one(c, failed)
+            else:
+                cr = _run_one(c, dry_run, keep_temps, quiet, scratch)
+
+            status[cr.key] = not cr.skipped and (dry_run or cr.result.success)
             out.append(cr)
 
         return out
 
-def _run_queue(cmdscripts, dry_run = False, keep_temps = 'fail', quiet = False):
-    sr = SerialRunner()
-    results = sr.run_all(cmdscripts, dry_run, keep_temps, quiet)
-    return results
-
 class ParallelRunner:
     def __init__(self, nprocs=None):
         self.nprocs = nprocs
 
     def parallelize(self, cmdscripts):
-        sems = set()
+        # each semaphore is split into count slots, a cmdscript holds
+        # one randomly chosen slot of each of its semaphores while it
+        # runs
 
         for c in cmdscripts:
             sem = c.varvals['_semaphores']
 
             queues = [f"sem:{s.name}:{random.randint(1, s.count)}" for s in sem]
             c._queue = tuple(sorted(queues))
-            c._sems = tuple([s.name for s in sorted(sem, key=lambda x: x.name)])
-
-            if len(c._sems):
-                sems.add(c._sems)
-
-            #logger.info(f"**** {c.name} from {c.cwd} ({queues})")
-
-        # build a semaphore dag
-        dag = {}
-
-        for st in sorted(sems, key=lambda k: len(k)):
-            dag[st] = 0
-            sts = set(st)
-            for x in dag:
-                if x == st: continue
-
-                if set(x).intersection(sts):
-                    dag[st] = max(dag[st], dag[x] + 1)
-
-        dag[tuple()] = -1
-
-        # build rounds
-        rounds = {}
-        for c in cmdscripts:
-            v = dag[c._sems]
-            if v not in rounds:
-                rounds[v] = []
 
-            rounds[v].append(c)
-
-        return rounds
-
-    def run_all(self, cmdscripts, dry_run = False, keep_temps = 'fail', quiet = False):
+    def run_all(self, cmdscripts, dry_run = False, keep_temps = 'fail', quiet = False, scratch = None):
         assert keep_temps in ('fail', 'never', 'always'), f"Incorrect value for keep_temps: {keep_temps}, must be one of fail, never or always"
 
         pool = multiprocessing.Pool(self.nprocs)
 
-        rounds = self.parallelize(cmdscripts)
-
-        out = []
-        for r in sorted(rounds.keys()):
-            if r == -1:
-                logger.debug(f"Launching all parallel")
-                out.extend(self._run_parallel(pool, rounds[r], dry_run, keep_temps, quiet))
-            else:
-                queues = dict([(x._queue, []) for x in rounds[r]])
-                for x in rounds[r]:
-                    queues[x._queue].append(x)
-
-                logger.debug(f"Launching queues on round {r}")
-
-                qres = pool.starmap(_run_queue,
-                                    [(queues[q], dry_run, keep_temps, quiet) for q in queues])
-
-                # wait for round to finish
+        self.parallelize(cmdscripts)
+
+        names = dict([(c.key, c.name) for c in cmdscripts])
+        status = {}
+        results = {}
+        held = set()
+        done = queue.Queue()
+        running = 0
+
+        pending = list(cmdscripts)
+        while pending or running:
+            # launch everything whose prerequisites have finished,
+            # skipping dependents of failures
+            waiting = []
+            for c in pending:
+                failed = _failed_deps(c, status, names)
+                if failed:
+                    results[c.key] = _skip_one(c, failed)
+                    status[c.key] = False
+                elif all([d in status for d in c.depends if d in names]) and not held.intersection(c._queue):
+                    logger.debug(f"Launching {c.name}")
+                    held.update(c._queue)
+                    pool.apply_async(_run_one, (c, dry_run, keep_temps, quiet, scratch),
+                                     callback=done.put, error_callback=done.put)
+                    running += 1
+                else:
+                    waiting.append(c)
 
-                for qr in qres:
-                    out.extend(qr)
+            pending = waiting
 
-        return out
+            if running:
+                cr = done.get()
+                if isinstance(cr, BaseException):
+                    raise cr
 
-    def _run_parallel(self, pool, cmdscripts, dry_run = False, keep_temps = 'fail', quiet = False):
-        res = pool.starmap(_run_one, [(c, dry_run, keep_temps, quiet) for c in cmdscripts])
-        return res
+                running -= 1
+                held.difference_update(cr._queue)
+                status[cr.key] = dry_run or cr.result.success
+                results[cr.key] = cr
 
+        return [results[c.key] for c in cmdscripts]